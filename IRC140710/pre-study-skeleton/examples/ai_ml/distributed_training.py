@@ -13,21 +13,35 @@ Usage:
 """
 
 import os
+import re
 import argparse
+import contextlib
 import time
 import socket
 from datetime import timedelta
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data import (
+    BatchSampler, DataLoader, DistributedSampler, TensorDataset)
 from torch.utils.tensorboard import SummaryWriter
 
 import torchvision
-import torchvision.transforms as transforms
+
+def first_slurm_host(nodelist):
+    """Return the first hostname of a compressed Slurm nodelist
+
+    e.g. 'gpu[007-010,012],login1' -> 'gpu007'
+         'rack[1-2]-node[01-04]'    -> 'rack1-node01'
+    """
+    # First entry up to a comma that isn't inside brackets
+    first_entry = re.match(r'(?:[^,\[]|\[[^\]]*\])*', nodelist).group(0)
+    # Replace each bracket group with the first value of its range/list
+    return re.sub(r'\[([^\],-]+)[^\]]*\]', r'\1', first_entry)
 
 def setup_distributed():
     """Initialize distributed training environment"""
@@ -38,14 +52,17 @@ def setup_distributed():
         world_size = int(os.environ['SLURM_NTASKS'])
         local_rank = int(os.environ['SLURM_LOCALID'])
         
-        # Get master address from Slurm
-        if 'SLURM_STEP_NODELIST' in os.environ:
-            # Parse nodelist to get first node as master
-            import subprocess
-            result = subprocess.run(['scontrol', 'show', 'hostname', 
-                                   os.environ['SLURM_STEP_NODELIST']], 
-                                  capture_output=True, text=True)
-            master_addr = result.stdout.split('\n')[0]
+        # Get master address from Slurm; the batch script normally resolves
+        # it once per job and exports MASTER_ADDR, so ranks only fall back to
+        # parsing the nodelist themselves when launched without it
+        nodelist = (os.environ.get('SLURM_STEP_NODELIST')
+                    or os.environ.get('SLURM_NODELIST'))
+        if 'MASTER_ADDR' in os.environ:
+            master_addr = os.environ['MASTER_ADDR']
+        elif nodelist:
+            # Parse nodelist in-process to get first node as master, rather
+            # than forking `scontrol show hostname` on every rank
+            master_addr = first_slurm_host(nodelist)
         else:
             master_addr = socket.gethostname()
             
@@ -100,40 +117,56 @@ class SimpleModel(nn.Module):
         super(SimpleModel, self).__init__()
         self.conv1 = nn.Conv2d(3, 32, kernel_size=3, padding=1)
         self.conv2 = nn.Conv2d(32, 64, kernel_size=3, padding=1)
-        self.pool = nn.MaxPool2d(2, 2)
-        self.fc1 = nn.Linear(64 * 8 * 8, 128)
+        # 64 channels at 8x8 after two 2x2 pools of a 32x32 input
+        self._fc_in = 64 * 8 * 8
+        self.fc1 = nn.Linear(self._fc_in, 128)
         self.fc2 = nn.Linear(128, num_classes)
-        self.relu = nn.ReLU()
-        self.dropout = nn.Dropout(0.5)
         
     def forward(self, x):
-        x = self.pool(self.relu(self.conv1(x)))
-        x = self.pool(self.relu(self.conv2(x)))
-        x = x.view(-1, 64 * 8 * 8)
-        x = self.relu(self.fc1(x))
-        x = self.dropout(x)
-        x = self.fc2(x)
-        return x
+        # In-place ReLUs avoid allocating a second copy of each activation map
+        x = F.max_pool2d(F.relu_(self.conv1(x)), 2)
+        x = F.max_pool2d(F.relu_(self.conv2(x)), 2)
+        x = torch.flatten(x, 1)
+        x = F.relu_(self.fc1(x))
+        x = F.dropout(x, 0.5, self.training)
+        return self.fc2(x)
+
+def decode_cifar10(root, train):
+    """Decode a CIFAR-10 split into (N, 3, 32, 32) uint8 images and labels"""
+    dataset = torchvision.datasets.CIFAR10(root=root, train=train, download=True)
+    images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2).contiguous()
+    labels = torch.tensor(dataset.targets, dtype=torch.long)
+    return images, labels
 
-def create_data_loaders(batch_size, rank, world_size):
+def create_data_loaders(batch_size, rank, world_size, root='./data'):
     """Create distributed data loaders"""
     
-    # Data preprocessing
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
-    ])
-    
-    # Load datasets
-    train_dataset = torchvision.datasets.CIFAR10(
-        root='./data', train=True, download=(rank == 0), transform=transform)
-    test_dataset = torchvision.datasets.CIFAR10(
-        root='./data', train=False, download=False, transform=transform)
-    
-    # Wait for rank 0 to finish downloading
+    # The whole dataset fits in RAM, so rank 0 decodes it once into a single
+    # blob of uint8 tensors and every rank just maps that file; the float
+    # conversion and normalization happen per batch on the GPU (see to_device)
+    blob_path = os.path.join(root, 'cifar10_u8.pt')
+    if rank == 0 and not os.path.exists(blob_path):
+        tr_x, tr_y = decode_cifar10(root, train=True)
+        te_x, te_y = decode_cifar10(root, train=False)
+        tmp_path = f'{blob_path}.tmp'
+        torch.save({'tr_x': tr_x, 'tr_y': tr_y, 'te_x': te_x, 'te_y': te_y},
+                   tmp_path)
+        os.replace(tmp_path, blob_path)
+    
+    # Wait for rank 0 to finish decoding
     if world_size > 1:
         dist.barrier()
     
+    # mmap shares one page-cache copy between all ranks on a node instead of
+    # each rank reading and unpickling the full dataset; it needs PyTorch 2.1,
+    # so older releases fall back to a regular load
+    load_kwargs = {}
+    if tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1):
+        load_kwargs['mmap'] = True
+    blob = torch.load(blob_path, **load_kwargs)
+    train_dataset = TensorDataset(blob['tr_x'], blob['tr_y'])
+    test_dataset = TensorDataset(blob['te_x'], blob['te_y'])
+    
     # Create distributed samplers
     train_sampler = DistributedSampler(
         train_dataset, num_replicas=world_size, rank=rank, shuffle=True)
@@ -141,43 +174,182 @@ def create_data_loaders(batch_size, rank, world_size):
         test_dataset, num_replicas=world_size, rank=rank, shuffle=False)
     
     # Create data loaders
+    # Sampling whole batches of indices makes each batch a single tensor
+    # gather instead of per-sample __getitem__ calls plus a collate; with no
+    # per-sample work left, worker processes would only add IPC overhead
+    loader_kwargs = dict(batch_size=None, num_workers=0, pin_memory=True)
+    
+    # drop_last keeps every training batch the same shape so the CUDA graphs
+    # captured by torch.compile(mode='reduce-overhead') are reused each step
     train_loader = DataLoader(
-        train_dataset, batch_size=batch_size, sampler=train_sampler,
-        num_workers=4, pin_memory=True)
+        train_dataset,
+        sampler=BatchSampler(train_sampler, batch_size, drop_last=True),
+        **loader_kwargs)
     test_loader = DataLoader(
-        test_dataset, batch_size=batch_size, sampler=test_sampler,
-        num_workers=4, pin_memory=True)
+        test_dataset,
+        sampler=BatchSampler(test_sampler, batch_size, drop_last=False),
+        **loader_kwargs)
     
     return train_loader, test_loader, train_sampler
 
-def train_epoch(model, train_loader, criterion, optimizer, epoch, rank, writer):
-    """Train for one epoch"""
+def to_device(data, target):
+    """Copy a uint8 batch to the current GPU and normalize it for the model"""
+    if torch.cuda.is_available():
+        data = data.cuda(non_blocking=True)
+        target = target.cuda(non_blocking=True)
+    
+    # Same result as ToTensor() + Normalize((0.5,) * 3, (0.5,) * 3), but the
+    # copy moves 4x fewer bytes; NHWC lets cuDNN pick Tensor-Core kernels
+    data = data.to(dtype=torch.float32, memory_format=torch.channels_last)
+    data = data.div_(255).sub_(0.5).div_(0.5)
+    return data, target
+
+class CUDAPrefetcher:
+    """Iterate a DataLoader while copying the next batch to the GPU on a side stream"""
+    def __init__(self, loader):
+        self.loader = loader
+        
+    def __len__(self):
+        return len(self.loader)
+    
+    def __iter__(self):
+        if not torch.cuda.is_available():
+            for batch in self.loader:
+                yield to_device(*batch)
+            return
+        
+        stream = torch.cuda.Stream()
+        batches = iter(self.loader)
+        
+        def preload():
+            batch = next(batches, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return to_device(*batch)
+        
+        batch = preload()
+        while batch is not None:
+            torch.cuda.current_stream().wait_stream(stream)
+            data, target = batch
+            # Tell the caching allocator these are now used on the compute stream
+            data.record_stream(torch.cuda.current_stream())
+            target.record_stream(torch.cuda.current_stream())
+            
+            # Start the next H2D copy before handing this batch to compute
+            batch = preload()
+            yield data, target
+
+def train_steps(model, train_loader, criterion, optimizer, scaler,
+                accum_steps=1):
+    """Yield the loss of each batch, stepping the optimizer every accum_steps"""
     model.train()
-    running_loss = 0.0
-    start_time = time.time()
-    
-    for batch_idx, (data, target) in enumerate(train_loader):
-        if torch.cuda.is_available():
-            data, target = data.cuda(), target.cuda()
+    use_amp = torch.cuda.is_available()
+    
+    # DDP's no_sync() skips the gradient allreduce on accumulation-only steps
+    no_sync = getattr(model, 'no_sync', contextlib.nullcontext)
+    optimizer.zero_grad(set_to_none=True)
+    
+    num_batches = len(train_loader)
+    for batch_idx, (data, target) in enumerate(CUDAPrefetcher(train_loader)):
+        is_step = ((batch_idx + 1) % accum_steps == 0
+                   or batch_idx + 1 == num_batches)
+        # The last window of the epoch may be short; average over the
+        # micro-batches it actually has so its update isn't scaled down
+        window_start = batch_idx - batch_idx % accum_steps
+        window_size = min(accum_steps, num_batches - window_start)
+        
+        with contextlib.nullcontext() if is_step else no_sync():
+            # Run convs/matmuls in FP16 on Tensor Cores; autocast keeps
+            # reductions such as the loss in FP32
+            with torch.cuda.amp.autocast(enabled=use_amp, dtype=torch.float16):
+                output = model(data)
+                loss = criterion(output, target)
+            
+            scaler.scale(loss / window_size).backward()
+        
+        if is_step:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
         
-        optimizer.zero_grad()
-        output = model(data)
-        loss = criterion(output, target)
-        loss.backward()
-        optimizer.step()
+        yield loss
+
+def train_steps_graphed(model, train_loader, criterion, optimizer,
+                        warmup_steps=11):
+    """Yield the loss of each batch, replaying the whole step as a CUDA graph"""
+    model.train()
+    
+    # GradScaler.step() can't be captured, so use BF16, which has FP32's
+    # exponent range and needs no loss scaling; without it stay in FP32
+    # rather than risk FP16 gradients silently underflowing to zero
+    use_bf16 = torch.cuda.is_bf16_supported()
+    
+    # Warm up on a side stream so cuDNN picks its algorithms and DDP/NCCL
+    # finish their lazy initialization before anything is captured
+    side_stream = torch.cuda.Stream()
+    graph = None
+    static_data = static_target = static_loss = None
+    
+    for batch_idx, (data, target) in enumerate(CUDAPrefetcher(train_loader)):
+        if batch_idx < warmup_steps:
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                optimizer.zero_grad(set_to_none=True)
+                with torch.cuda.amp.autocast(enabled=use_bf16,
+                                             dtype=torch.bfloat16,
+                                             cache_enabled=False):
+                    output = model(data)
+                    loss = criterion(output, target)
+                loss.backward()
+                optimizer.step()
+            torch.cuda.current_stream().wait_stream(side_stream)
+        else:
+            if graph is None:
+                # Gradients are allocated from the graph's private pool, so
+                # each replay overwrites them instead of accumulating
+                static_data = torch.empty_like(data)
+                static_target = torch.empty_like(target)
+                optimizer.zero_grad(set_to_none=True)
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph):
+                    with torch.cuda.amp.autocast(enabled=use_bf16,
+                                                 dtype=torch.bfloat16,
+                                                 cache_enabled=False):
+                        static_output = model(static_data)
+                        static_loss = criterion(static_output, static_target)
+                    static_loss.backward()
+                    optimizer.step()
+            
+            static_data.copy_(data, non_blocking=True)
+            static_target.copy_(target, non_blocking=True)
+            graph.replay()
+            loss = static_loss
         
-        running_loss += loss.item()
+        yield loss
+
+def train_epoch(steps, num_batches, epoch, rank, writer):
+    """Train for one epoch, logging the losses yielded by a step generator"""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # Summed on the device so the loop only syncs with the host when logging
+    loss_sum = torch.zeros((), device=device)
+    start_time = time.time()
+    
+    for batch_idx, loss in enumerate(steps):
+        loss_sum += loss.detach()
         
         # Log progress
         if batch_idx % 100 == 0 and rank == 0:
-            print(f'Epoch {epoch}, Batch {batch_idx}, Loss: {loss.item():.6f}')
+            current = loss.item()
+            print(f'Epoch {epoch}, Batch {batch_idx}, Loss: {current:.6f}')
             
             if writer:
-                global_step = epoch * len(train_loader) + batch_idx
-                writer.add_scalar('Loss/Train', loss.item(), global_step)
+                global_step = epoch * num_batches + batch_idx
+                writer.add_scalar('Loss/Train', current, global_step)
     
+    # .item() waits for the queued GPU work, so read the clock after it
+    avg_loss = (loss_sum / num_batches).item()
     epoch_time = time.time() - start_time
-    avg_loss = running_loss / len(train_loader)
     
     if rank == 0:
         print(f'Epoch {epoch} completed in {epoch_time:.2f}s, Avg Loss: {avg_loss:.6f}')
@@ -187,30 +359,26 @@ def train_epoch(model, train_loader, criterion, optimizer, epoch, rank, writer):
 def validate(model, test_loader, criterion, rank):
     """Validate the model"""
     model.eval()
-    test_loss = 0
-    correct = 0
-    total = 0
-    
-    with torch.no_grad():
-        for data, target in test_loader:
-            if torch.cuda.is_available():
-                data, target = data.cuda(), target.cuda()
-            
-            output = model(data)
-            test_loss += criterion(output, target).item()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    
+    # [loss, correct, total] stay on the device so the loop never blocks on
+    # a host sync; FP64 keeps the integer counts exact
+    metrics = torch.zeros(3, dtype=torch.float64, device=device)
+    
+    with torch.inference_mode():
+        for data, target in CUDAPrefetcher(test_loader):
+            with torch.cuda.amp.autocast(enabled=torch.cuda.is_available()):
+                output = model(data)
+                metrics[0] += criterion(output, target).double()
             
             _, predicted = torch.max(output.data, 1)
-            total += target.size(0)
-            correct += (predicted == target).sum().item()
+            metrics[1] += (predicted == target).sum().double()
+            metrics[2] += target.size(0)
     
     # Gather metrics from all processes
     if dist.is_initialized():
-        metrics = torch.tensor([test_loss, correct, total], dtype=torch.float)
-        if torch.cuda.is_available():
-            metrics = metrics.cuda()
-        
         dist.all_reduce(metrics, op=dist.ReduceOp.SUM)
-        test_loss, correct, total = metrics.tolist()
+    test_loss, correct, total = metrics.tolist()
     
     accuracy = 100.0 * correct / total
     avg_loss = test_loss / len(test_loader)
@@ -232,12 +400,34 @@ def main():
                         help='save the trained model')
     parser.add_argument('--log-dir', type=str, default='./logs',
                         help='directory for tensorboard logs')
+    parser.add_argument('--accum-steps', type=int, default=1,
+                        help='number of batches to accumulate per optimizer step')
+    parser.add_argument('--no-compile', action='store_true',
+                        help='run the model eagerly instead of via torch.compile')
+    parser.add_argument('--cuda-graph', action='store_true',
+                        help='capture the full training step as a CUDA graph '
+                             '(replaces torch.compile)')
     
     args = parser.parse_args()
+    args.cuda_graph = args.cuda_graph and torch.cuda.is_available()
+    if args.accum_steps < 1:
+        parser.error('--accum-steps must be at least 1')
+    if args.cuda_graph and args.accum_steps > 1:
+        parser.error('--accum-steps is not supported with --cuda-graph')
+    
+    # NCCL's async error watchdog is incompatible with graph capture
+    if args.cuda_graph:
+        os.environ.setdefault('TORCH_NCCL_ASYNC_ERROR_HANDLING', '0')
+        os.environ.setdefault('NCCL_ASYNC_ERROR_HANDLING', '0')
     
     # Initialize distributed training
     rank, world_size, local_rank = setup_distributed()
     
+    # Autotune conv algorithms for the fixed input shape and allow TF32 for
+    # any matmuls left in FP32
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    
     # Set up logging (only on rank 0)
     writer = None
     if rank == 0:
@@ -248,13 +438,35 @@ def main():
     # Create model
     model = SimpleModel(num_classes=10)
     
+    # Pointwise-op fusion comes from torch.compile (Inductor) below; the
+    # --no-compile, --cuda-graph and CPU paths run the module eagerly
+    use_compile = (torch.cuda.is_available() and not args.no_compile
+                   and not args.cuda_graph and hasattr(torch, 'compile'))
+    
+    # Small buckets let the allreduce of late layers start while backward is
+    # still running on early ones; the model has no conditional parameters,
+    # so the autograd graph is static and needn't be re-traced every step
+    ddp_kwargs = dict(bucket_cap_mb=1, gradient_as_bucket_view=True,
+                      static_graph=True, find_unused_parameters=False)
+    
     # Move model to appropriate device
     if torch.cuda.is_available():
-        model = model.cuda(local_rank)
+        model = model.cuda(local_rank).to(memory_format=torch.channels_last)
         if world_size > 1:
-            model = DDP(model, device_ids=[local_rank])
+            # DDP must be constructed on a side stream to be graph-capturable
+            ddp_stream = torch.cuda.Stream() if args.cuda_graph else None
+            with torch.cuda.stream(ddp_stream):
+                model = DDP(model, device_ids=[local_rank], **ddp_kwargs)
+        
+        # Let Inductor fuse the small pointwise ops and replay the step as a
+        # CUDA graph; graph breaks fall back to eager instead of aborting
+        if use_compile:
+            import torch._dynamo
+            torch._dynamo.config.suppress_errors = True
+            model = torch.compile(model, mode='reduce-overhead',
+                                  fullgraph=False, backend='inductor')
     elif world_size > 1:
-        model = DDP(model)
+        model = DDP(model, **ddp_kwargs)
     
     # Create data loaders
     train_loader, test_loader, train_sampler = create_data_loaders(
@@ -262,8 +474,17 @@ def main():
     
     # Define loss and optimizer
     criterion = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    # Update all parameters in one fused kernel rather than a Python loop of
+    # per-parameter launches; fused= needs PyTorch 2.0, foreach= predates it
+    adam_kwargs = dict(lr=args.lr, capturable=args.cuda_graph)
+    if torch.cuda.is_available():
+        if int(torch.__version__.split('.')[0]) >= 2:
+            adam_kwargs['fused'] = True
+        else:
+            adam_kwargs['foreach'] = True
+    optimizer = optim.Adam(model.parameters(), **adam_kwargs)
     scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=5, gamma=0.1)
+    scaler = torch.cuda.amp.GradScaler(enabled=torch.cuda.is_available())
     
     # Training loop
     start_time = time.time()
@@ -274,8 +495,14 @@ def main():
             train_sampler.set_epoch(epoch)
         
         # Train
-        train_loss = train_epoch(model, train_loader, criterion, optimizer, 
-                               epoch, rank, writer)
+        if args.cuda_graph:
+            # Recaptured each epoch so the scheduler's learning rate is picked up
+            steps = train_steps_graphed(model, train_loader, criterion,
+                                        optimizer)
+        else:
+            steps = train_steps(model, train_loader, criterion, optimizer,
+                                scaler, accum_steps=args.accum_steps)
+        train_loss = train_epoch(steps, len(train_loader), epoch, rank, writer)
         
         # Validate
         test_loss, accuracy = validate(model, test_loader, criterion, rank)
@@ -297,7 +524,9 @@ def main():
         
         # Save model
         if args.save_model:
-            model_to_save = model.module if hasattr(model, 'module') else model
+            model_to_save = getattr(model, '_orig_mod', model)
+            if hasattr(model_to_save, 'module'):
+                model_to_save = model_to_save.module
             torch.save(model_to_save.state_dict(), 'distributed_model.pth')
             print("Model saved as 'distributed_model.pth'")
         
@@ -0,0 +1,116 @@
+#include <mpi.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+/* Number of messages kept in flight by the bandwidth pipeline */
+#ifndef WINDOW
+#define WINDOW 16
+#endif
+
+#define LATENCY_ITERS 1000
+#define TARGET_BYTES (256L << 20)  /* ~256 MiB streamed per measurement */
+
+/*
+ * Stream `count` messages between rank 0 (sender) and rank 1 (receiver),
+ * keeping up to WINDOW non-blocking requests outstanding and reposting each
+ * slot as soon as MPI_Waitany reports it complete.
+ */
+static void stream_messages(int rank, char* bufs, int msg_size, long count) {
+    MPI_Request reqs[WINDOW];
+    long posted = 0, completed = 0;
+    int peer = 1 - rank;
+
+    for (int w = 0; w < WINDOW && posted < count; ++w, ++posted) {
+        char* slot = bufs + (size_t)w * msg_size;
+        if (rank == 0)
+            MPI_Isend(slot, msg_size, MPI_CHAR, peer, 0, MPI_COMM_WORLD, &reqs[w]);
+        else
+            MPI_Irecv(slot, msg_size, MPI_CHAR, peer, 0, MPI_COMM_WORLD, &reqs[w]);
+    }
+    int active = (int)posted;
+
+    while (completed < count) {
+        int idx;
+        MPI_Waitany(active, reqs, &idx, MPI_STATUS_IGNORE);
+        ++completed;
+        if (posted < count) {
+            char* slot = bufs + (size_t)idx * msg_size;
+            if (rank == 0)
+                MPI_Isend(slot, msg_size, MPI_CHAR, peer, 0, MPI_COMM_WORLD, &reqs[idx]);
+            else
+                MPI_Irecv(slot, msg_size, MPI_CHAR, peer, 0, MPI_COMM_WORLD, &reqs[idx]);
+            ++posted;
+        }
+    }
+
+    /* Receiver acknowledges so the sender's timing covers full delivery */
+    char ack = 0;
+    if (rank == 0)
+        MPI_Recv(&ack, 1, MPI_CHAR, peer, 1, MPI_COMM_WORLD, MPI_STATUS_IGNORE);
+    else
+        MPI_Send(&ack, 1, MPI_CHAR, peer, 1, MPI_COMM_WORLD);
+}
+
+int main(int argc, char** argv) {
+    MPI_Init(&argc, &argv);
+    int rank, size;
+    MPI_Comm_rank(MPI_COMM_WORLD, &rank);
+    MPI_Comm_size(MPI_COMM_WORLD, &size);
+
+    if (size < 2 || argc < 2) {
+        if (rank == 0) fprintf(stderr, "ERROR: usage: mpirun -np 2 %s <message_size>\n", argv[0]);
+        MPI_Finalize();
+        return 1;
+    }
+
+    int msg_size = atoi(argv[1]);
+    if (msg_size <= 0) {
+        if (rank == 0) fprintf(stderr, "ERROR: invalid message size %s\n", argv[1]);
+        MPI_Finalize();
+        return 1;
+    }
+
+    /* Extra ranks only take part in the barriers */
+    char* bufs = NULL;
+    if (rank < 2) {
+        bufs = (char*)malloc((size_t)WINDOW * msg_size);
+        memset(bufs, 0, (size_t)WINDOW * msg_size);
+    }
+
+    /* Latency: blocking ping-pong, half the round-trip time */
+    MPI_Barrier(MPI_COMM_WORLD);
+    double t0 = MPI_Wtime();
+    for (int i = 0; i < LATENCY_ITERS && rank < 2; ++i) {
+        if (rank == 0) {
+            MPI_Send(bufs, msg_size, MPI_CHAR, 1, 0, MPI_COMM_WORLD);
+            MPI_Recv(bufs, msg_size, MPI_CHAR, 1, 0, MPI_COMM_WORLD, MPI_STATUS_IGNORE);
+        } else {
+            MPI_Recv(bufs, msg_size, MPI_CHAR, 0, 0, MPI_COMM_WORLD, MPI_STATUS_IGNORE);
+            MPI_Send(bufs, msg_size, MPI_CHAR, 0, 0, MPI_COMM_WORLD);
+        }
+    }
+    double latency = ((MPI_Wtime() - t0) / (2.0 * LATENCY_ITERS)) * 1e6; // microseconds
+
+    /* Bandwidth: pipelined Isend/Irecv window, after one warm-up window */
+    long count = TARGET_BYTES / msg_size;
+    if (count < WINDOW) count = WINDOW;
+    if (rank < 2) stream_messages(rank, bufs, msg_size, WINDOW);
+
+    MPI_Barrier(MPI_COMM_WORLD);
+    t0 = MPI_Wtime();
+    if (rank < 2) stream_messages(rank, bufs, msg_size, count);
+    double elapsed = MPI_Wtime() - t0;
+    double bandwidth = ((double)count * msg_size) / elapsed / 1e6; // MB/s
+
+    if (rank == 0) {
+        printf("Message size: %d bytes, window: %d\n", msg_size, WINDOW);
+        printf("Latency: %.3f us\n", latency);
+        printf("Bandwidth: %.2f MB/s\n", bandwidth);
+        printf("Bandwidth test completed\n");
+    }
+
+    free(bufs);
+    MPI_Finalize();
+    return 0;
+}
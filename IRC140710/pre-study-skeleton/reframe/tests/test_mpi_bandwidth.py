@@ -1,6 +1,29 @@
+import bisect
+
 import reframe as rfm
 import reframe.utility.sanity as sn
 
+# Expected bandwidth/latency ranges based on interconnect type, one entry per
+# message-size class; BW_SIZE_LIMITS holds the largest size in each class.
+# These would be customized for specific HPC systems
+BW_SIZE_LIMITS = (4096, 65536)
+BW_REFERENCES = (
+    # Small messages - latency bound
+    ((50, 200, None, 'MB/s'), (0.5, 2.0, None, 'us')),
+    # Medium messages
+    ((500, 1500, None, 'MB/s'), (2.0, 10.0, None, 'us')),
+    # Large messages - bandwidth bound
+    ((2000, 4000, None, 'MB/s'), (10.0, 100.0, None, 'us')),
+)
+
+# Expected scaling efficiency for MPIBandwidthScaling
+SCALING_BASE_BW = 3000  # MB/s for 2 nodes
+SCALING_EFFICIENCY = 0.85  # 85% scaling efficiency
+SCALING_PER_PAIR_BW = SCALING_BASE_BW * SCALING_EFFICIENCY
+
+# Memory bandwidth stops scaling with threads once every channel is busy
+MEMORY_CHANNELS_PER_SOCKET = 8
+
 @rfm.simple_test
 class MPIBandwidthTest(rfm.RegressionTest):
     """
@@ -11,6 +34,10 @@ class MPIBandwidthTest(rfm.RegressionTest):
     valid_systems = ['*']
     valid_prog_environs = ['builtin']
     
+    # Built with -march=native, so compile on the partition's own nodes
+    # rather than a login node whose CPU may differ
+    build_locally = False
+    
     # Test parameters
     message_sizes = rfm.parameter([1024, 4096, 16384, 65536, 262144, 1048576])  # 1KB to 1MB
     
@@ -18,13 +45,18 @@ class MPIBandwidthTest(rfm.RegressionTest):
     num_tasks = 2
     num_tasks_per_node = 1  # Force inter-node communication
     
+    sourcesdir = '../../examples/mpi'
     executable = 'mpirun'
     
+    # Messages kept in flight by the Isend/Irecv pipeline in mpi_bandwidth.c
+    window_size = 16
+    
     @rfm.run_before('compile')
     def setup_build(self):
         self.build_system = 'SingleSource'
         self.sourcepath = 'mpi_bandwidth.c'
-        self.build_system.cflags = ['-O2', '-std=c99']
+        self.build_system.cflags = ['-O3', '-march=native', '-funroll-loops',
+                                    '-std=c99', f'-DWINDOW={self.window_size}']
         self.build_system.ldflags = ['-lm']
     
     @rfm.run_before('run')
@@ -69,20 +101,8 @@ class MPIBandwidthTest(rfm.RegressionTest):
     def set_perf_reference(self):
         """Set performance references based on message size and system"""
         
-        # Define expected bandwidth ranges based on interconnect type
-        # These would be customized for specific HPC systems
-        if self.message_sizes <= 4096:
-            # Small messages - latency bound
-            expected_bw_range = (50, 200, None, 'MB/s')
-            expected_lat_range = (0.5, 2.0, None, 'us')
-        elif self.message_sizes <= 65536:
-            # Medium messages
-            expected_bw_range = (500, 1500, None, 'MB/s')
-            expected_lat_range = (2.0, 10.0, None, 'us')
-        else:
-            # Large messages - bandwidth bound
-            expected_bw_range = (2000, 4000, None, 'MB/s')
-            expected_lat_range = (10.0, 100.0, None, 'us')
+        size_class = bisect.bisect_left(BW_SIZE_LIMITS, self.message_sizes)
+        expected_bw_range, expected_lat_range = BW_REFERENCES[size_class]
         
         self.reference = {
             '*': {
@@ -109,6 +129,10 @@ class MPIBandwidthScaling(rfm.RegressionTest):
     valid_systems = ['*']
     valid_prog_environs = ['builtin']
     
+    # Built with -march=native, so compile on the partition's own nodes
+    # rather than a login node whose CPU may differ
+    build_locally = False
+    
     # Scale from 2 to 16 nodes (if available)
     node_counts = rfm.parameter([2, 4, 8, 16])
     message_size = 1048576  # 1MB messages
@@ -117,7 +141,7 @@ class MPIBandwidthScaling(rfm.RegressionTest):
     def setup_build(self):
         self.build_system = 'SingleSource'
         self.sourcepath = 'mpi_alltoall.c'
-        self.build_system.cflags = ['-O2', '-std=c99']
+        self.build_system.cflags = ['-O3', '-march=native', '-std=c99']
         
     @rfm.run_before('run')
     def setup_run(self):
@@ -161,12 +185,8 @@ class MPIBandwidthScaling(rfm.RegressionTest):
     def set_perf_reference(self):
         """Set scaling expectations"""
         
-        # Expected scaling efficiency
-        base_bw = 3000  # MB/s for 2 nodes
-        scaling_efficiency = 0.85  # 85% scaling efficiency
-        
-        expected_aggregate = base_bw * self.node_counts * scaling_efficiency
-        expected_per_pair = base_bw * scaling_efficiency
+        expected_aggregate = SCALING_PER_PAIR_BW * self.node_counts
+        expected_per_pair = SCALING_PER_PAIR_BW
         
         self.reference = {
             '*': {
@@ -191,18 +211,25 @@ class MemoryBandwidthTest(rfm.RegressionTest):
     valid_systems = ['*'] 
     valid_prog_environs = ['builtin']
     
+    # Built with -march=native, so compile on the partition's own nodes
+    # rather than a login node whose CPU may differ
+    build_locally = False
+    
     # Test different access patterns
     access_pattern = rfm.parameter(['sequential', 'random', 'stride'])
     array_sizes = rfm.parameter([1048576, 8388608, 67108864])  # 1MB, 8MB, 64MB
+    num_threads = rfm.parameter([1, 4, 16, 'all'])  # 'all' = every core on the node
     
     num_tasks = 1
-    num_cpus_per_task = 1
     
     @rfm.run_before('compile')
     def setup_build(self):
         self.build_system = 'SingleSource'
         self.sourcepath = 'memory_bandwidth.c'
-        self.build_system.cflags = ['-O2', '-fopenmp', '-std=c99']
+        # -ffast-math lets the compiler reassociate the sum reduction so
+        # the sequential kernel vectorizes
+        self.build_system.cflags = ['-O3', '-march=native', '-funroll-loops',
+                                    '-ffast-math', '-fopenmp', '-std=c99']
         self.build_system.ldflags = ['-lm', '-fopenmp']
         
     @rfm.run_before('run')
@@ -213,10 +240,33 @@ class MemoryBandwidthTest(rfm.RegressionTest):
             '10'  # Number of iterations
         ]
         
+        processor = self.current_partition.processor
+        if self.num_threads == 'all':
+            # Physical cores, not SMT siblings, to match OMP_PLACES=cores
+            self.skip_if(not processor.num_cores,
+                         'processor topology not configured for this partition')
+            num_threads = processor.num_cores
+        else:
+            num_threads = self.num_threads
+            self.skip_if(processor.num_cores and num_threads > processor.num_cores,
+                         f'partition has fewer than {num_threads} cores')
+        self.num_cpus_per_task = num_threads
+        
+        # One thread per core, packed close together so they share a socket
         self.env_vars = {
-            'OMP_NUM_THREADS': '1'
+            'OMP_NUM_THREADS': str(num_threads),
+            'OMP_PROC_BIND': 'close',
+            'OMP_PLACES': 'cores'
         }
         
+        # Allocate pages on the NUMA node the threads run on; only bind to
+        # node 0 when the threads fit on its cores rather than spanning nodes
+        self.job.launcher.modifier = 'numactl'
+        self.job.launcher.modifier_options = ['--localalloc']
+        cores_per_numa_node = processor.num_cores_per_numa_node
+        if cores_per_numa_node and num_threads <= cores_per_numa_node:
+            self.job.launcher.modifier_options.append('--cpunodebind=0')
+        
     @rfm.sanity_function
     def assert_completion(self):
         return sn.assert_found(r'Memory bandwidth test completed', self.stdout)
@@ -238,7 +288,13 @@ class MemoryBandwidthTest(rfm.RegressionTest):
             expected_bw = (10.0, 25.0, None, 'GB/s')  # Cache effects
         else:  # random
             expected_bw = (2.0, 10.0, None, 'GB/s')   # Poor cache utilization
-            
+        
+        # Ranges above are per thread; aggregate bandwidth grows with the
+        # thread count until the memory channels saturate
+        scale = min(self.num_cpus_per_task, MEMORY_CHANNELS_PER_SOCKET)
+        low, high, upper, unit = expected_bw
+        expected_bw = (low * scale, high * scale, upper, unit)
+        
         self.reference = {
             '*': {
                 'memory_bandwidth': expected_bw